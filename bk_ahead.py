@@ -4,6 +4,8 @@ import pandas as pd
 import os
 from shutil import copyfile
 
+from bk_common import fresh_parquet, wide_columns
+
 CSV_PATH = "data/data_concept.csv"
 BACKUP_PATH = "data/data_concept_bk.csv"
 # CSV_PATH = "data/data_industry.csv"
@@ -12,29 +14,37 @@ KEEP_DAYS = 90   # 保留最近90个交易日
 
 
 def main():
-    if not os.path.exists(CSV_PATH):
+    # bk_data --no-csv 轮询后 parquet 比 CSV 新：以 parquet 为准，否则轮询写入的列会被旧 CSV 覆盖丢掉
+    pq_path = fresh_parquet(CSV_PATH)
+    if not pq_path and not os.path.exists(CSV_PATH):
         print("❌ data_concept.csv 不存在")
         return
 
-    # ========= 1️⃣ 备份 =========
-    print("🔹 备份原始文件...")
-    copyfile(CSV_PATH, BACKUP_PATH)
-    print(f"✅ 已备份为 {BACKUP_PATH}")
-
-    # ========= 2️⃣ 读取 =========
-    print("🔹 读取CSV...")
-    df = pd.read_csv(CSV_PATH, index_col=0)
+    # ========= 1️⃣ 只读表头判断是否需要裁剪 =========
+    header = wide_columns(CSV_PATH)
+    index_col = "row_key" if pq_path else header[0]  # parquet 的 row_key 索引列在 schema 末尾
 
     # 所有日期列（排除 row_key）
-    date_cols = list(df.columns)
+    date_cols = [c for c in header if c != index_col]
 
     if len(date_cols) <= KEEP_DAYS:
         print("⚠️ 当前交易日数量不足90天，无需裁剪")
         return
 
-    # ========= 3️⃣ 取最近90列 =========
+    # ========= 2️⃣ 备份 =========
+    if os.path.exists(CSV_PATH):
+        print("🔹 备份原始文件...")
+        copyfile(CSV_PATH, BACKUP_PATH)
+        print(f"✅ 已备份为 {BACKUP_PATH}")
+
+    # ========= 3️⃣ 只读取最近90列 =========
     last_cols = date_cols[-KEEP_DAYS:]
-    df_new = df[last_cols]
+    if pq_path:
+        print(f"🔹 读取parquet（比CSV新）: {pq_path}")
+        df_new = pd.read_parquet(pq_path, columns=last_cols)  # row_key 索引随 pandas 元数据一并读回
+    else:
+        print("🔹 读取CSV...")
+        df_new = pd.read_csv(CSV_PATH, index_col=0, usecols=[index_col] + last_cols, engine="pyarrow")  # 多线程解析
 
     print(f"🔹 原列数: {len(date_cols)}")
     print(f"🔹 保留列数: {len(last_cols)}")
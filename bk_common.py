@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# bk_top_ind / bk_top_con 共用的读表、解析、输出函数；宽表 parquet 路径与新鲜度判断 bk_data_common / bk_ahead 也用
+
+import os
+import json
+from functools import lru_cache
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# ================== 读表 ==================
+def parquet_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+def fresh_parquet(csv_path):
+    """
+    bk_data 同步写出的 parquet 不比 CSV 旧（或只有 parquet，--no-csv）时返回其路径；
+    否则 None（CSV 被单独改写过，如 bk_ahead）
+    """
+    pq_path = parquet_path(csv_path)
+    if os.path.exists(pq_path) and (not os.path.exists(csv_path) or os.path.getmtime(pq_path) >= os.path.getmtime(csv_path)):
+        return pq_path
+    return None
+
+def load_wide(csv_path):
+    """读宽表（row_key 为普通列）：优先读 parquet（省去 CSV 文本解析）"""
+    pq_path = fresh_parquet(csv_path)
+    if pq_path:
+        return pd.read_parquet(pq_path).reset_index()
+    return pd.read_csv(csv_path, engine="pyarrow")  # 多线程解析；仍为 object 列，parse_cells 不变
+
+def wide_columns(csv_path):
+    """只读表头（parquet 读 schema，CSV 读首行），用于先确定日期列"""
+    pq_path = fresh_parquet(csv_path)
+    if pq_path:
+        return pq.read_schema(pq_path).names
+    return pd.read_csv(csv_path, nrows=0).columns.tolist()
+
+
+# ================== long_df 缓存 ==================
+CACHE_KEY = b"bk_cache_key"
+
+def long_cache_key(csv_path, display_cols, exclude_boards):
+    """缓存键：宽表版本（CSV / parquet 较新的 mtime）+ 展示日期列 + 排除板块，任一变化即重建"""
+    mtime_ns = max(os.stat(p).st_mtime_ns for p in (csv_path, parquet_path(csv_path)) if os.path.exists(p))
+    return json.dumps(
+        [mtime_ns, list(display_cols), sorted(exclude_boards)],
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+def load_long_cache(path, key):
+    """键一致才读缓存，否则返回 None"""
+    if not os.path.exists(path):
+        return None
+    meta = pq.read_schema(path).metadata or {}
+    if meta.get(CACHE_KEY) != key:
+        return None
+    return pq.read_table(path).to_pandas()
+
+def save_long_cache(long_df, path, key):
+    table = pa.Table.from_pandas(long_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), CACHE_KEY: key})
+    pq.write_table(table, path, compression="snappy")
+
+
+# ================== 单元格解析 ==================
+CELL_FIELDS = ["rank", "pct", "val", "turnover", "up", "down", "leader"]
+
+
+def parse_cells(frame):
+    """
+    批量解析 rank|pct|val|turnover|up|down|leader 单元格：
+    整表展平后只 split 一次，按字段返回与 frame 同形状的宽表
+    """
+    flat = pd.Series(frame.to_numpy(dtype=object).ravel(), dtype=object)
+    parts = flat.str.split("|", n=6, expand=True).reindex(columns=range(7))  # 兼容旧数据
+
+    parsed = {}
+    for k, field in enumerate(CELL_FIELDS[:-1]):
+        vals = pd.to_numeric(parts[k], errors="coerce").to_numpy(dtype=float)
+        parsed[field] = pd.DataFrame(vals.reshape(frame.shape), index=frame.index, columns=frame.columns)
+    parsed["pct"] = parsed["pct"] / 100.0
+
+    leader = parts[6].fillna("").to_numpy(dtype=object)
+    parsed["leader"] = pd.DataFrame(leader.reshape(frame.shape), index=frame.index, columns=frame.columns)
+    return parsed
+
+
+# ================== HTML 输出 ==================
+@lru_cache(maxsize=1)
+def _plotlyjs():
+    """plotly.js（约 4.7MB）每个进程只读一次，多个 LOOKBACK 的页面共用"""
+    from plotly.offline import get_plotlyjs  # 用到时才导入：bk_data 系列只用读表函数，不必加载 plotly
+    return get_plotlyjs()
+
+
+def write_fig_html(fig, path, plotlyjs="inline"):
+    """
+    代替 fig.write_html(include_plotlyjs="inline")：图只序列化一次 fig.to_json()，
+    直接写进最小 HTML 模板，分段写盘不拼整页大字符串
+    plotlyjs="inline"：plotly.js 内联，离线可打开；"cdn"：只引用 cdn.plot.ly，页面小约 4.7MB，但打开需联网
+    """
+    spec = fig.to_json().replace("</", "<\\/")  # 防止数据里的 </script> 截断脚本
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<html>\n<head><meta charset="utf-8" /></head>\n<body>\n')
+        f.write('<script type="text/javascript">window.PlotlyConfig = {MathJaxConfig: \'local\'};</script>\n')
+        if plotlyjs == "cdn":
+            from plotly.offline import get_plotlyjs_version
+            f.write(f'<script src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js" charset="utf-8"></script>\n')
+        else:
+            f.write('<script type="text/javascript">')
+            f.write(_plotlyjs())
+            f.write('</script>\n')
+        f.write('<div id="gd" class="plotly-graph-div" style="height:100%; width:100%;"></div>\n')
+        f.write('<script type="text/javascript">\nvar spec = ')
+        f.write(spec)
+        f.write(';\nPlotly.newPlot("gd", spec.data, spec.layout, {"responsive": true});\n</script>\n</body>\n</html>\n')
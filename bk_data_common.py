@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# bk_data_ind / bk_data_con 共用的抓取、缓存、读写、交易日历函数
+
+import io, os, csv, time, math, random, signal, socket, asyncio
+from typing import List, Tuple, Optional, Dict
+from datetime import datetime
+from functools import lru_cache
+from bisect import bisect_right
+
+import aiohttp
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+import numpy as np
+import pandas as pd
+
+from bk_common import parquet_path, fresh_parquet
+
+# ================== Tunables ==================
+RETRY_TIMES = 4
+MARKET_CLOSE = "15:00"      # 收盘时间：此后开始抓取的今天列视为定稿
+CACHE_DIR = ".cache"        # 本地缓存目录（K线、交易日历）
+HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Referer": "https://quote.eastmoney.com/",
+    "Accept": "application/json, text/plain, */*",
+    "Connection": "keep-alive",
+}
+
+LIST_URL   = "https://push2.eastmoney.com/api/qt/clist/get"           # 批量列表（今天用它）
+KLINE_URL  = "https://push2his.eastmoney.com/api/qt/stock/kline/get"  # 历史K线（仅基线）
+
+INTERRUPTED = False
+def _sigint_handler(signum, frame):
+    global INTERRUPTED
+    INTERRUPTED = True
+signal.signal(signal.SIGINT, _sigint_handler)
+
+
+def interrupted() -> bool:
+    """Ctrl+C 标志；from-import 只拿到导入时的值，调用方须通过此函数读"""
+    return INTERRUPTED
+
+
+# =============== HTTP helpers ===============
+class KeepAliveAdapter(HTTPAdapter):
+    """连接开 SO_KEEPALIVE（urllib3 默认已开 TCP_NODELAY），请求间隔长时连接不被中途掐断"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def resp_json(resp: requests.Response) -> dict:
+    """用 orjson 解析响应体，比 resp.json()（标准库 json）快数倍"""
+    return orjson.loads(resp.content)
+
+
+def ffloat(v) -> float:
+    """clist 数值字段转 float：缺失 / "-" / "--" / 非法值 → NaN"""
+    if v in (None, "", "--"):
+        return math.nan
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+# =============== klines ===============
+def parse_klines(kl) -> pd.DataFrame:
+    """
+    fields2：
+    0 f51=日期, 1 f52=开盘, 2 f53=收盘, 3 f54=最高, 4 f55=最低,
+    5 f56=成交量, 6 f57=成交额, 7 f58=振幅, 8 f59=涨跌幅(%), 9 f60=涨跌额, 10 f61=换手率
+    整段交给 read_csv（C 解析器）一次解析，只取 日期/收盘/涨跌幅 三列
+    """
+    if not kl:
+        return pd.DataFrame(columns=["trade_date", "pct_chg", "close"])
+    df = pd.read_csv(
+        io.StringIO("\n".join(kl)),
+        header=None,
+        usecols=[0, 2, 8],
+        dtype={0: str},
+    )
+    df.columns = ["trade_date", "close", "pct_chg"]
+    df["close"] = pd.to_numeric(df["close"], errors="coerce")
+    df["pct_chg"] = pd.to_numeric(df["pct_chg"], errors="coerce")
+    return df[["trade_date", "pct_chg", "close"]]
+
+
+_KLINE_PARAMS = {
+    "fields1": "f1,f2,f3,f4,f5",
+    "fields2": "f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61",
+    "klt": 101, "fqt": 0,
+}
+
+
+def _kline_params(bk_code: str, beg: str, end: str) -> dict:
+    # 常量字段共用模板，每次只填 secid/beg/end
+    params = _KLINE_PARAMS.copy()
+    params["secid"] = f"90.{bk_code}"
+    params["beg"] = beg
+    params["end"] = end
+    return params
+
+
+# =============== async kline fetch（基线 / his 今天并发） ===============
+class AsyncPacer:
+    """发起节奏控制（协程版）：并发请求共享一个节奏，发起时刻按 rpm 最小间隔 + sleep + jitter 错开，网络等待互相重叠。"""
+
+    def __init__(self, min_interval_s: float, base_sleep: float, jitter: float):
+        self.min_interval_s = max(0.0, min_interval_s)
+        self.base_sleep = max(0.0, base_sleep)
+        self.jitter = max(0.0, jitter)
+        self.next_ts = time.monotonic()  # 下一次最早可发起的时刻（单调时钟，不受系统校时影响）
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            total = max(0.0, self.next_ts - time.monotonic()) + self.base_sleep + random.random() * self.jitter
+            if total > 0:
+                await asyncio.sleep(total)
+            self.next_ts = time.monotonic() + self.min_interval_s
+
+    async def cooldown(self, secs: float):
+        """全局冷却：持锁睡眠，期间不再发起新请求。"""
+        async with self.lock:
+            await asyncio.sleep(secs)
+
+
+async def _afetch_klines(session: aiohttp.ClientSession, bk_code: str, beg: str, end: str, verbose_http: bool,
+                         timeout: Optional[float] = None) -> list:
+    """只取回原始 klines 行，解析留到调用方（基线由 write_baseline 对全部板块一次完成）"""
+    params = _kline_params(bk_code, beg, end)
+    kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+    t0 = time.time()
+    async with session.get(KLINE_URL, params=params, **kwargs) as resp:
+        body = await resp.read()
+    if verbose_http:
+        dt = (time.time() - t0) * 1000.0
+        path = KLINE_URL.split("//", 1)[-1].split("/", 1)[-1]
+        log_params = {k: params.get(k) for k in ("fs","secid","beg","end","klt","lmt")}
+        print(f"[http] GET /{path} {log_params} -> {resp.status} ({dt:.0f}ms)")
+    resp.raise_for_status()
+    return (orjson.loads(body).get("data") or {}).get("klines") or []
+
+
+def _keepalive_socket(addr_info) -> socket.socket:
+    """aiohttp 建连用的 socket：同 KeepAliveAdapter 开 SO_KEEPALIVE"""
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return sock
+
+
+def _aio_session(timeout_s: float, concurrency: int) -> aiohttp.ClientSession:
+    # 一个事件循环跑全部在途请求；连接池复用 TCP/TLS，DNS 结果整轮复用（默认 10s 过期）
+    timeout = aiohttp.ClientTimeout(total=timeout_s)
+    connector = aiohttp.TCPConnector(
+        limit=max(1, concurrency), keepalive_timeout=60, ttl_dns_cache=300, socket_factory=_keepalive_socket,
+    )
+    return aiohttp.ClientSession(headers=HEADERS, timeout=timeout, connector=connector, trust_env=True)
+
+
+async def fetch_klines_async(
+    session: aiohttp.ClientSession,
+    boards: List[Tuple[str, str]],
+    beg: str,
+    end: str,
+    concurrency: int,
+    pacer: AsyncPacer,
+    cooldown_after: float,
+    cooldown_secs: float,
+    verbose_http: bool,
+    tag: str = "full",
+    retries: int = RETRY_TIMES,
+    backoff0: float = 0.6,
+    jitter: float = 0.35,
+    timeout: Optional[float] = None,
+) -> List[Optional[list]]:
+    """
+    并发抓一批板块的日K：Semaphore 限制在途请求数，AsyncPacer 控制发起节奏
+    返回与 boards 一一对应的 klines（失败/中断为 None）
+    """
+    total = len(boards)
+    sem = asyncio.Semaphore(max(1, concurrency))
+    consec_fail = 0
+
+    async def fetch_one(i: int, code: str, name: str):
+        nonlocal consec_fail
+        async with sem:
+            if INTERRUPTED:
+                return None
+            await pacer.wait()
+
+            ok = False; err = None; kl = None
+            backoff = backoff0
+            for attempt in range(retries):
+                try:
+                    kl = await _afetch_klines(session, code, beg, end, verbose_http, timeout=timeout)
+                    ok = True; break
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    err = e; await asyncio.sleep(backoff + random.uniform(0, jitter)); backoff *= 2
+                except Exception as e:
+                    err = e; await asyncio.sleep(backoff); backoff *= 2
+
+            if ok and kl:
+                consec_fail = 0
+                print(f"[{tag} {i:02d}/{total}] {code}|{name} ok ({len(kl)})")
+                return kl
+
+            consec_fail += 1
+            print(f"[{tag} {i:02d}/{total}] {code}|{name} FAIL: {err}")
+            if consec_fail >= cooldown_after:
+                print(f"[cooldown] consecutive fails={consec_fail} → sleep {cooldown_secs}s")
+                consec_fail = 0
+                await pacer.cooldown(cooldown_secs)
+            return None
+
+    return list(await asyncio.gather(*(fetch_one(i, c, n) for i, (c, n) in enumerate(boards, start=1))))
+
+
+async def fetch_baseline_async(
+    boards: List[Tuple[str, str]],
+    beg: str,
+    end: str,
+    timeout_s: float,
+    concurrency: int,
+    pacer: AsyncPacer,
+    cooldown_after: int,
+    cooldown_secs: float,
+    verbose_http: bool,
+) -> List[Tuple[str, list]]:
+    """基线并发抓取：返回 [(row_key, klines), ...]，顺序与 boards 一致（失败/中断的板块不返回）"""
+    async with _aio_session(timeout_s, concurrency) as session:
+        results = await fetch_klines_async(
+            session, boards, beg, end, concurrency, pacer, cooldown_after, cooldown_secs, verbose_http,
+        )
+
+    if INTERRUPTED:
+        print("[warn] interrupted, flushing baseline…")
+    return [(f"{c}|{n}", kl) for (c, n), kl in zip(boards, results) if kl]
+
+
+async def fetch_today_his_async(
+    boards: List[Tuple[str, str]],
+    today_str: str,
+    timeout_s: float,
+    concurrency: int,
+    pacer: AsyncPacer,
+    cooldown_after: int,
+    cooldown_secs: float,
+    pass2_timeout: float,
+    pass2_pacer: AsyncPacer,
+    verbose_http: bool,
+) -> pd.DataFrame:
+    """
+    his 模式抓今天：Pass1 并发抓全部板块，Pass2 对失败板块逐个慢速重试（同一会话，复用连接）
+    返回与 boards 同序的 DataFrame[bk_code, bk_name, pct_chg, close]，失败板块 pct_chg/close 为 NaN
+    """
+    pct_a = np.full(len(boards), np.nan)
+    close_a = np.full(len(boards), np.nan)
+
+    def _fill(idx, results):
+        # 成功板块各取首条 K 线拼成一段一次解析，按位置写进数组（不再逐板块建 dict / DataFrame）
+        hit = [i for i, kl in zip(idx, results) if kl]
+        if hit:
+            parsed = parse_klines([kl[0] for kl in results if kl])
+            pct_a[hit] = parsed["pct_chg"].to_numpy(dtype=float)
+            close_a[hit] = parsed["close"].to_numpy(dtype=float)
+
+    async with _aio_session(timeout_s, concurrency) as session:
+        # Pass1
+        results = await fetch_klines_async(
+            session, boards, today_str, today_str, concurrency, pacer, cooldown_after, cooldown_secs, verbose_http,
+            tag="today",
+        )
+        _fill(range(len(boards)), results)
+        fails = [i for i, kl in enumerate(results) if not kl]
+
+        # Pass2（可选）：单并发、更慢节奏、更长超时、多一次重试
+        if fails and not INTERRUPTED:
+            print(f"[info] Pass2 retry for {len(fails)} failed boards (slower pacing)…")
+            results2 = await fetch_klines_async(
+                session, [boards[i] for i in fails], today_str, today_str, 1, pass2_pacer, math.inf, 0, verbose_http,
+                tag="pass2", retries=RETRY_TIMES + 1, backoff0=1.0, jitter=0.5, timeout=pass2_timeout,
+            )
+            _fill(fails, results2)
+
+    if INTERRUPTED:
+        print("[warn] interrupted by user, flushing partial…")
+    return pd.DataFrame({
+        "bk_code": [c for c, _ in boards],
+        "bk_name": [n for _, n in boards],
+        "pct_chg": pct_a,
+        "close": close_a,
+    })
+
+
+# =============== kline cache ===============
+def kline_cache_path(fs: str, beg: str, end: str) -> str:
+    return os.path.join(CACHE_DIR, f"klines_{fs.replace(':', '').replace('+', '_')}_{beg}_{end}.json")
+
+
+def load_kline_cache(path: str) -> Dict[str, list]:
+    """基线 K 线缓存：{row_key: klines}；不存在返回空 dict"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def save_kline_cache(path: str, klines: Dict[str, list]):
+    """写入本窗口的缓存，同 fs 其它窗口（beg/end 不同，已不会再用）的旧缓存一并删掉"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    prefix = os.path.basename(path).rsplit("_", 2)[0] + "_"
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(prefix) and name.endswith(".json") and os.path.join(CACHE_DIR, name) != path:
+            os.remove(os.path.join(CACHE_DIR, name))
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(klines))
+
+
+# =============== cell helpers ===============
+def fmt_cells(rank, pct, close, turnover=None, up=None, down=None, leader=None) -> pd.Series:
+    """fmt_cell 的整列版本：入参为等长 Series（可省略的字段传 None），规则与 fmt_cell 一致。"""
+    index = rank.index
+
+    def _num(s, fmt):
+        if s is None:
+            return pd.Series("", index=index, dtype=object)
+        s = s.astype(float)
+        return pd.Series(np.char.mod(fmt, s.to_numpy()), index=index, dtype=object).where(s.notna(), "")
+
+    def _count(s):
+        if s is None:
+            return pd.Series("0", index=index, dtype=object)
+        s = s.astype(object)
+        return s.astype(str).where(s.notna() & (s != ""), "0")
+
+    r = rank.astype("Int64").astype(str).where(rank.notna(), "")
+    p = _num(pct, "%.2f")
+    c = _num(close, "%.4f").str.rstrip("0").str.rstrip(".")
+    t = _num(turnover, "%.2f")
+    u = _count(up)
+    d = _count(down)
+    l = pd.Series("", index=index, dtype=object) if leader is None else leader.fillna("").astype(str)
+
+    cells = r + "|" + p + "|" + c + "|" + t + "|" + u + "|" + d + "|" + l
+    empty = (r == "") & (p == "") & (c == "") & (t == "") & (u == "") & (d == "") & (l == "")
+    return cells.where(~empty, "")
+
+
+# =============== wide table read / write ===============
+def _write_csv(wide: pd.DataFrame, out_csv: str):
+    """
+    宽表全是字符串单元格，直接用 csv.writer 写 numpy 数组，跳过 to_csv 的逐列格式化；
+    输出与 to_csv(encoding="utf-8-sig", index_label="row_key") 逐字节一致（缺失写空串）
+    """
+    cells = wide.to_numpy(dtype=object)
+    cells[pd.isna(cells)] = ""
+    rows = np.column_stack([wide.index.to_numpy(dtype=object), cells])
+    with open(out_csv, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f, lineterminator=os.linesep)
+        w.writerow(["row_key", *wide.columns])
+        w.writerows(rows.tolist())
+
+
+def save_wide(wide: pd.DataFrame, out_csv: str, write_csv: bool = True):
+    """
+    CSV 仍是主文件（入库、兼容 bk_ahead / 手工查看）；
+    同时写一份 parquet（字典编码 + snappy），后续读取不再逐格解析文本
+    write_csv=False（--no-csv，盘中反复轮询用）：只写 parquet，CSV 留到下次不带该参数时再导出
+    """
+    wide = wide.rename_axis("row_key")
+    if write_csv:
+        _write_csv(wide, out_csv)
+    wide.where(wide.ne("")).to_parquet(parquet_path(out_csv), compression="snappy")  # 空串与 CSV 读回一致记为缺失
+
+
+def wide_exists(out_csv: str) -> bool:
+    return os.path.exists(out_csv) or os.path.exists(parquet_path(out_csv))
+
+
+def load_wide(out_csv: str) -> pd.DataFrame:
+    """parquet 不比 CSV 旧（或只有 parquet）就读 parquet；CSV 被单独改写过（如 bk_ahead）则回退读 CSV"""
+    pq = fresh_parquet(out_csv)
+    if pq:
+        wide = pd.read_parquet(pq)
+    else:
+        wide = pd.read_csv(out_csv, index_col=0, engine="pyarrow")  # 多线程解析
+    # 单元格一律按字符串处理：整列为空的日期列会被推断成 float64，转回 object，
+    # 否则 patch_today 往里写字符串会触发 dtype 不兼容（pandas 将来直接报错）
+    non_str = wide.columns[wide.dtypes != object]
+    if len(non_str):
+        wide[non_str] = wide[non_str].astype(object)
+    return wide
+
+
+# =============== trade calendar ===============
+@lru_cache(maxsize=1)
+def get_trade_dates() -> Tuple[str, ...]:
+    """
+    交易日历（'YYYY-MM-DD' 升序），每个进程只取一次；
+    当天已取过就读 CACHE_DIR 里的缓存，不再请求新浪
+    """
+    path = os.path.join(CACHE_DIR, "trade_dates.json")
+    if os.path.exists(path) and datetime.fromtimestamp(os.path.getmtime(path)).date() == datetime.now().date():
+        with open(path, "rb") as f:
+            return tuple(orjson.loads(f.read()))
+
+    import akshare as ak  # akshare 导入很重（秒级），只在缓存失效真要请求日历时才导入
+    trade_cal = ak.tool_trade_date_hist_sina()
+    trade_dates = trade_cal[trade_cal['trade_date'].notna()]['trade_date'].tolist()
+    trade_dates = tuple(sorted(d.strftime("%Y-%m-%d") if hasattr(d, "strftime") else str(d) for d in trade_dates))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(trade_dates))
+    return trade_dates
+
+
+def get_latest_trade_date():
+    today = datetime.now().strftime("%Y-%m-%d")
+    try:
+        trade_dates = get_trade_dates()
+        i = bisect_right(trade_dates, today)  # 二分找最后一个 <= 今天的交易日
+        if i:
+            return trade_dates[i - 1]
+    except Exception as e:
+        print(f"[WARN] 获取交易日失败，使用今天: {e}")
+    return today
+
+
+def baseline_begin(today_col: str, n_days: int) -> str:
+    """基线起始日：交易日历里截至 today_col 的倒数第 n_days 个交易日（正好 n_days 天）；取不到日历时退回 n_days*2 个自然日"""
+    try:
+        trade_dates = get_trade_dates()
+        i = bisect_right(trade_dates, today_col)  # trade_dates[:i] 即截至 today_col 的交易日
+        if 0 < n_days <= i:
+            return trade_dates[i - n_days].replace("-", "")
+    except Exception as e:
+        print(f"[WARN] 获取交易日失败，基线按 {n_days*2} 个自然日请求: {e}")
+    return (pd.Timestamp(today_col) - pd.Timedelta(days=n_days*2)).strftime("%Y%m%d")
+
+
+def close_ts(last_trade_day) -> float:
+    """该交易日收盘时刻的时间戳"""
+    close_t = datetime.strptime(MARKET_CLOSE, "%H:%M").time()
+    return datetime.combine(last_trade_day, close_t).timestamp()
+
+
+def _fetch_mark_path(out_csv: str) -> str:
+    return os.path.join(CACHE_DIR, "fetched_" + os.path.splitext(os.path.basename(out_csv))[0] + ".json")
+
+
+def mark_fetched(out_csv: str, today_col: str, fetch_ts: float):
+    """记下今天列是哪一刻开始抓的（不用文件 mtime：git pull / bk_ahead / 跨收盘才写完都会改 mtime）"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_fetch_mark_path(out_csv), "wb") as f:
+        f.write(orjson.dumps({"today_col": today_col, "fetch_ts": fetch_ts}))
+
+
+def today_is_final(wide: pd.DataFrame, today_col: str, out_csv: str, last_trade_day) -> bool:
+    """宽表已含今天列、且本机记录的抓取开始时刻在该交易日收盘后 → 今天数据已定稿，无需再请求接口。"""
+    if today_col not in wide.columns or not wide[today_col].notna().any():
+        return False
+    path = _fetch_mark_path(out_csv)
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        mark = orjson.loads(f.read())
+    return mark.get("today_col") == today_col and mark.get("fetch_ts", 0) >= close_ts(last_trade_day)
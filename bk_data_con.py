@@ -20,41 +20,32 @@ A股板块抓取（Eastmoney，批量抓“今天” + 稳健二轮 + 基线建
 | 示例   | 885301        | 半导体           | 12.34        | 3.25   | 1.23   | 8    | 2    | "中芯国际"      |
 """
 
-import os, sys, time, math, random, argparse, signal
-from typing import List, Tuple, Optional, Dict
+import sys, time, math, argparse, asyncio
+from typing import List, Tuple
 from datetime import datetime
 from pandas.tseries.offsets import BDay
 
 import requests
-from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from requests.exceptions import ProxyError, ConnectionError as ReqConnErr, ReadTimeout
 
+import numpy as np
 import pandas as pd
-import akshare as ak
+
+from bk_data_common import (
+    RETRY_TIMES, MARKET_CLOSE, HEADERS, LIST_URL,
+    interrupted, KeepAliveAdapter, resp_json, ffloat, parse_klines,
+    AsyncPacer, fetch_baseline_async, fetch_today_his_async,
+    kline_cache_path, load_kline_cache, save_kline_cache,
+    fmt_cells, save_wide, wide_exists, load_wide,
+    get_latest_trade_date, baseline_begin, close_ts, mark_fetched, today_is_final,
+)
 
 # ================== Tunables ==================
 N_DAYS = 90
-RETRY_TIMES = 4
-HEADERS = {
-    "User-Agent": "Mozilla/5.0",
-    "Referer": "https://quote.eastmoney.com/",
-    "Accept": "application/json, text/plain, */*",
-    "Connection": "keep-alive",
-}
-
-LIST_URL   = "https://push2.eastmoney.com/api/qt/clist/get"           # 批量列表（今天用它）
-KLINE_URL  = "https://push2his.eastmoney.com/api/qt/stock/kline/get"  # 历史K线（仅基线）
 # BOARD_FS   = "m:90+t:2"     # 行业
 BOARD_FS   = "m:90+t:3"     # 概念
 OUTPUT_CSV = "data/data_concept.csv"
 
-INTERRUPTED = False
-def _sigint_handler(signum, frame):
-    global INTERRUPTED
-    INTERRUPTED = True
-signal.signal(signal.SIGINT, _sigint_handler)
-
 
 # =============== HTTP & throttle helpers ===============
 def build_session(timeout_s: float) -> requests.Session:
@@ -68,28 +59,14 @@ def build_session(timeout_s: float) -> requests.Session:
         raise_on_status=False,
         respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=16, pool_maxsize=16)
+    # pool_block：连接池满时等待复用已有连接，而不是另开一条用完即弃的新连接
+    adapter = KeepAliveAdapter(max_retries=retry, pool_connections=16, pool_maxsize=16, pool_block=True)
     s.mount("http://", adapter)
     s.mount("https://", adapter)
     s.request_timeout = timeout_s  # 自定义属性
     return s
 
 
-def polite_sleep(min_interval_s: float, base_sleep: float, jitter: float, last_ts_holder: list):
-    """满足 rpm 的最小间隔，再叠加自定义等待与抖动。"""
-    now = time.time()
-    last_ts = last_ts_holder[0]
-    need = 0.0
-    if last_ts is not None:
-        elapsed = now - last_ts
-        if elapsed < min_interval_s:
-            need = (min_interval_s - elapsed)
-    total = max(0.0, need) + max(0.0, base_sleep) + (random.random() * max(0.0, jitter))
-    if total > 0:
-        time.sleep(total)
-    last_ts_holder[0] = time.time()
-
-
 # =============== Eastmoney fetchers ===============
 def http_get(session: requests.Session, url: str, params: dict, verbose_http: bool) -> requests.Response:
     t0 = time.time()
@@ -118,25 +95,26 @@ def fetch_board_list_basic(
     all_rows: List[Tuple[str, str]] = []
     seen = set()
 
-    for pn in range(1, max_pages + 1):
-        params = {
-            "pn": pn,
-            "pz": page_size,   # 实际最大 100
-            "po": 1,
-            "np": 1,
-            "fltt": 2,
-            "invt": 2,
-            "fid": "f3",
-            "fs": fs,
-            "fields": "f12,f14",
-            # "fields": "f12,f14,f2,f3,f8,f104,f105,f128",
-        }
-
+    # 翻页时只有 pn 变化，参数字典建一次、循环里只改 pn
+    params = {
+        "pn": 1,
+        "pz": page_size,   # 实际最大 100
+        "po": 1,
+        "np": 1,
+        "fltt": 2,
+        "invt": 2,
+        "fid": "f3",
+        "fs": fs,
+        "fields": "f12,f14",
+        # "fields": "f12,f14,f2,f3,f8,f104,f105,f128",
+    }
 
+    for pn in range(1, max_pages + 1):
+        params["pn"] = pn
         r = http_get(session, LIST_URL, params, verbose_http)
         r.raise_for_status()
 
-        data = r.json().get("data") or {}
+        data = resp_json(r).get("data") or {}
         diff = data.get("diff") or []
 
         if not diff:
@@ -183,27 +161,30 @@ def fetch_board_list_today(
     - 打印抓取数量日志
     """
 
-    rows = []
+    # 按列收集（每字段一个 list），最后一次性建 DataFrame，不逐行建 dict
+    codes, names, closes, pcts, turnovers, ups, downs, leaders = [], [], [], [], [], [], [], []
     seen = set()
 
-    for pn in range(1, max_pages + 1):
-        params = {
-            "pn": pn,
-            "pz": page_size,   # 实际最大 100
-            "po": 1,
-            "np": 1,
-            "fltt": 2,
-            "invt": 2,
-            "fid": "f3",
-            "fs": fs,
-            # "fields": "f12,f14,f2,f3",
-            "fields": "f12,f14,f2,f3,f8,f104,f105,f128",
-        }
+    # 翻页时只有 pn 变化，参数字典建一次、循环里只改 pn
+    params = {
+        "pn": 1,
+        "pz": page_size,   # 实际最大 100
+        "po": 1,
+        "np": 1,
+        "fltt": 2,
+        "invt": 2,
+        "fid": "f3",
+        "fs": fs,
+        # "fields": "f12,f14,f2,f3",
+        "fields": "f12,f14,f2,f3,f8,f104,f105,f128",
+    }
 
+    for pn in range(1, max_pages + 1):
+        params["pn"] = pn
         r = http_get(session, LIST_URL, params, verbose_http)
         r.raise_for_status()
 
-        data = r.json().get("data") or {}
+        data = resp_json(r).get("data") or {}
         diff = data.get("diff") or []
 
         if not diff:
@@ -222,101 +203,42 @@ def fetch_board_list_today(
                 continue
             seen.add(key)
 
-            try:
-                close = float(it.get("f2")) if it.get("f2") not in (None, "", "--") else math.nan
-            except Exception:
-                close = math.nan
-
-            try:
-                pct = float(it.get("f3")) if it.get("f3") not in (None, "", "--") else math.nan
-            except Exception:
-                pct = math.nan
-
-            try:
-                turnover = float(it.get("f8")) if it.get("f8") not in (None, "", "--") else math.nan
-            except Exception:
-                turnover = math.nan
-
-            up_count = it.get("f104") or ""
-            down_count = it.get("f105") or ""
-            leader = it.get("f128") or ""
-
-            # rows.append({
-            #     "bk_code": code,
-            #     "bk_name": name,
-            #     "close": close,
-            #     "pct_chg": pct,
-            # })
-
-            rows.append({
-                "bk_code": code,
-                "bk_name": name,
-                "close": close,
-                "pct_chg": pct,
-                "turnover": turnover,
-                "up_count": up_count,
-                "down_count": down_count,
-                "leader": leader,
-            })
-
+            codes.append(code)
+            names.append(name)
+            closes.append(ffloat(it.get("f2")))
+            pcts.append(ffloat(it.get("f3")))
+            turnovers.append(ffloat(it.get("f8")))
+            ups.append(it.get("f104") or "")
+            downs.append(it.get("f105") or "")
+            leaders.append(it.get("f128") or "")
             page_new += 1
 
         total = data.get("total")
         print(
             f"[info] today clist page {pn}: "
             f"fetched={len(diff)}, new={page_new}, "
-            f"accumulated={len(rows)}, total={total}"
+            f"accumulated={len(codes)}, total={total}"
         )
 
         # 已抓全
-        if total and len(rows) >= total:
+        if total and len(codes) >= total:
             break
 
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame({
+        "bk_code": codes,
+        "bk_name": names,
+        "close": closes,
+        "pct_chg": pcts,
+        "turnover": turnovers,
+        "up_count": ups,
+        "down_count": downs,
+        "leader": leaders,
+    })
     print(f"[summary] today clist fetched rows={len(df)}")
 
     return df
 
 
-
-
-def _parse_klines(kl):
-    """
-    fields2：
-    0 f51=日期, 1 f52=开盘, 2 f53=收盘, 3 f54=最高, 4 f55=最低,
-    5 f56=成交量, 6 f57=成交额, 7 f58=振幅, 8 f59=涨跌幅(%), 9 f60=涨跌额, 10 f61=换手率
-    """
-    recs = []
-    for row in kl or []:
-        parts = row.split(",")
-        if len(parts) >= 11:
-            date = parts[0]
-            try:
-                close = float(parts[2]) if parts[2] != "" else math.nan
-            except ValueError:
-                close = math.nan
-            try:
-                pct = float(parts[8]) if parts[8] != "" else math.nan
-            except ValueError:
-                pct = math.nan
-            recs.append((date, pct, close))
-    return recs
-
-
-def _fetch_range(session: requests.Session, bk_code: str, beg: str, end: str, verbose_http: bool):
-    params = {
-        "fields1": "f1,f2,f3,f4,f5",
-        "fields2": "f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61",
-        "klt": 101, "fqt": 0,
-        "secid": f"90.{bk_code}",
-        "beg": beg, "end": end,
-    }
-    r = http_get(session, KLINE_URL, params, verbose_http)
-    r.raise_for_status()
-    kl = (r.json().get("data") or {}).get("klines")
-    return _parse_klines(kl)
-
-
 # =============== cell helpers ===============
 # def fmt_cell(rank: Optional[int], pct: Optional[float], close: Optional[float]) -> str:
 #     r = "" if rank is None else str(int(rank))
@@ -349,20 +271,45 @@ def fmt_cell(rank, pct, close, turnover=None, up=None, down=None, leader=None):
     return "|".join(parts)
 
 
-
-
 # =============== write helpers ===============
-def write_baseline(all_rows: list, out_csv: str):
-    all_df = pd.concat(all_rows, ignore_index=True)
-    all_df["trade_date"] = pd.to_datetime(all_df["trade_date"]).dt.date
-    all_df["rank"] = all_df.groupby("trade_date")["pct_chg"].rank(ascending=False, method="first")
-    all_df["row_key"] = all_df["bk_code"] + "|" + all_df["bk_name"]
-    all_df["cell"] = all_df.apply(lambda r: fmt_cell(int(r["rank"]) if pd.notna(r["rank"]) else None,
-                                                     r["pct_chg"], r["close"]), axis=1)
-    pv = all_df.pivot_table(index="row_key", columns="trade_date", values="cell", aggfunc="first")
-    pv.columns = [c.strftime("%Y-%m-%d") for c in pv.columns]
-    pv = pv.sort_index(axis=1)
-    pv.to_csv(out_csv, encoding="utf-8-sig", index_label="row_key")
+def write_baseline(all_rows: List[Tuple[str, list]], out_csv: str, write_csv: bool = True):
+    # 所有板块的 klines 拼成一段一次解析，row_key 按每板块行数展开（不再逐板块建 DataFrame 再 concat）
+    keys = [k for k, _ in all_rows]
+    lens = [len(kl) for _, kl in all_rows]
+    all_df = parse_klines([line for _, kl in all_rows for line in kl])
+    row_idx, row_keys = pd.factorize(np.repeat(keys, lens))  # 行号按板块出现顺序
+    col_idx, dates = pd.factorize(pd.to_datetime(all_df["trade_date"]), sort=True)
+    shape = (len(row_keys), len(dates))
+
+    # 同一 (板块, 日期) 重复出现（板块列表重复 / 接口重复返回）时只保留第一条
+    _, first = np.unique(row_idx * shape[1] + col_idx, return_index=True)
+    row_idx, col_idx = row_idx[first], col_idx[first]
+
+    # 直接铺成 板块 × 日期 的二维数组（不再走长表 pivot）
+    pct = np.full(shape, np.nan, dtype=np.float32)  # 两位小数，float32 足够
+    close = np.full(shape, np.nan)
+    present = np.zeros(shape, dtype=bool)
+    pct[row_idx, col_idx] = all_df["pct_chg"].to_numpy(dtype=np.float32)[first]
+    close[row_idx, col_idx] = all_df["close"].to_numpy(dtype=float)[first]
+    present[row_idx, col_idx] = True
+    del all_df  # 长表到此用完，写盘前释放
+
+    # 每列一次 argsort 求名次：稳定排序 → 同涨幅按板块出现顺序（同 rank(method="first")），NaN 排最后且不给名次
+    order = np.argsort(-pct, axis=0, kind="stable")
+    rank = np.empty(shape)
+    np.put_along_axis(rank, order, np.arange(1, shape[0] + 1, dtype=float)[:, None], axis=0)
+    rank[np.isnan(pct)] = np.nan
+    rank_dtype = "Int16" if shape[0] < np.iinfo(np.int16).max else "Int32"
+
+    cells = fmt_cells(
+        pd.Series(rank.ravel()).astype(rank_dtype),
+        pd.Series(pct.ravel()),
+        pd.Series(close.ravel()),
+    ).to_numpy(dtype=object)
+    cells[~present.ravel()] = np.nan  # 当天无 K 线的格子留空
+    pv = pd.DataFrame(cells.reshape(shape), index=pd.Index(row_keys, name="row_key"), columns=dates.strftime("%Y-%m-%d"))
+    pv = pv.sort_index()
+    save_wide(pv, out_csv, write_csv)
     print(f"[done] wrote baseline to {out_csv}")
 
 
@@ -399,7 +346,7 @@ def write_baseline(all_rows: list, out_csv: str):
 #     wide.to_csv(out_csv, encoding="utf-8-sig", index_label="row_key")
 #     print(f"[done] patched today({today_col}) into {out_csv}")
 
-def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_csv: str):
+def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_csv: str, write_csv: bool = True):
     """
     TODAY 更新规则：
     1) 接口有的数据 → 更新
@@ -411,12 +358,12 @@ def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_
     df_today = df_today.copy()
 
     # ===== 1. rank =====
-    if df_today["pct_chg"].notna().any():
-        df_today["rank"] = df_today["pct_chg"].rank(
-            ascending=False, method="first"
-        )
-    else:
-        df_today["rank"] = pd.NA
+    # 稳定 argsort：同涨幅按接口返回顺序排名（同 rank(method="first")），NaN 不给名次
+    pct = df_today["pct_chg"].astype(float).to_numpy()
+    valid = np.flatnonzero(~np.isnan(pct))
+    rank = np.full(len(pct), np.nan)
+    rank[valid[np.argsort(-pct[valid], kind="stable")]] = np.arange(1, len(valid) + 1)
+    df_today["rank"] = rank
 
     df_today["row_key"] = df_today["bk_code"] + "|" + df_today["bk_name"]
 
@@ -429,17 +376,14 @@ def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_
     #     axis=1,
     # )
 
-    df_today["cell_new"] = df_today.apply(
-        lambda r: fmt_cell(
-            int(r["rank"]) if pd.notna(r["rank"]) else None,
-            r["pct_chg"],
-            r["close"],
-            r.get("turnover"),
-            r.get("up_count"),
-            r.get("down_count"),
-            r.get("leader"),
-        ),
-        axis=1,
+    df_today["cell_new"] = fmt_cells(  # 整列格式化，代替逐行 apply(fmt_cell)
+        df_today["rank"],
+        df_today["pct_chg"],
+        df_today["close"],
+        df_today.get("turnover"),
+        df_today.get("up_count"),
+        df_today.get("down_count"),
+        df_today.get("leader"),
     )
 
 
@@ -456,20 +400,18 @@ def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_
         for k in new_keys:
             print(f"  + {k}")
 
-        # 创建空行并 append
-        append_df = pd.DataFrame(index=new_keys, columns=wide.columns)
-        wide = pd.concat([wide, append_df])
+        # 一次 reindex 追加空行（新行在末尾），不再另建空 DataFrame 再 concat
+        wide = wide.reindex(wide.index.append(new_keys))
+        wide.index.name = "row_key"
 
     # ===== 异常检测：接口缺失但 CSV 今天已有 =====
     if today_col in wide.columns:
-        existing_today = wide[today_col]
         missing_keys = wide.index.difference(new_series.index)
+        missing_today = wide[today_col].reindex(missing_keys)
 
-        # CSV 里今天有值，但接口没返回
-        abnormal_keys = [
-            k for k in missing_keys
-            if pd.notna(existing_today.get(k)) and str(existing_today.get(k)).strip() != ""
-        ]
+        # CSV 里今天有值，但接口没返回（整列掩码判断，不逐 key .get）
+        has_val = missing_today.notna() & missing_today.astype(str).str.strip().ne("")
+        abnormal_keys = missing_keys[has_val.to_numpy()].tolist()
 
         if abnormal_keys:
             print(f"[warn] {len(abnormal_keys)} boards missing from API but kept from CSV:")
@@ -489,40 +431,16 @@ def patch_today(wide: pd.DataFrame, df_today: pd.DataFrame, today_col: str, out_
     wide.loc[mask, today_col] = aligned_new.loc[mask]
 
     # ===== 5. 日期列排序 =====
-    def _to_dt(x):
-        try:
-            return pd.to_datetime(x)
-        except Exception:
-            return pd.NaT
-
-    cols_dt = pd.Series({c: _to_dt(c) for c in wide.columns})
-    date_cols = cols_dt[cols_dt.notna()].sort_values().index.tolist()
-    other_cols = [c for c in wide.columns if c not in date_cols]
+    cols_dt = pd.to_datetime(wide.columns, errors="coerce")  # 整个列名一次转换，非日期列为 NaT
+    is_date = cols_dt.notna()
+    date_cols = wide.columns[is_date][np.argsort(cols_dt[is_date], kind="stable")].tolist()
+    other_cols = wide.columns[~is_date].tolist()
     wide = wide[date_cols + other_cols] if other_cols else wide[date_cols]
 
-    wide.to_csv(out_csv, encoding="utf-8-sig", index_label="row_key")
+    save_wide(wide, out_csv, write_csv)
     print(f"[done] patched today({today_col}) into {out_csv}")
 
 
-
-def get_latest_trade_date():
-    today = datetime.now().strftime("%Y-%m-%d")
-    try:
-        trade_cal = ak.tool_trade_date_hist_sina()
-        trade_dates = trade_cal[trade_cal['trade_date'].notna()]['trade_date'].tolist()
-        trade_dates = [d.strftime("%Y-%m-%d") if hasattr(d, "strftime") else str(d) for d in trade_dates]
-        if today in trade_dates:
-            return today
-        for d in reversed(trade_dates):
-            if d < today:
-                return d
-    except Exception as e:
-        print(f"[WARN] 获取交易日失败，使用今天: {e}")
-    return today
-
-
-
-
 # =============== main ===============
 def build_csv(
     fs: str,
@@ -538,6 +456,9 @@ def build_csv(
     pass2_sleep: float,
     verbose_http: bool,
     today_mode: str,
+    concurrency: int,
+    refresh: bool,
+    write_csv: bool = True,
 ):
     session = build_session(timeout_s)
 
@@ -566,16 +487,22 @@ def build_csv(
 
 
     print(f"[info] updating data for trading day: {today_col}")
+    fetch_ts = time.time()  # 本次抓取开始时刻：收盘前开始的抓取即使收盘后才写完，也不算定稿
 
     # 读旧CSV
-    if os.path.exists(out_csv):
-        wide = pd.read_csv(out_csv, index_col=0)
+    if wide_exists(out_csv):
+        wide = load_wide(out_csv)
         wide.columns = [str(c) for c in wide.columns]
         print(f"[info] CSV exists → update TODAY via '{today_mode}'.")
     else:
         wide = pd.DataFrame()
         print("[info] No CSV found → full fetch to build baseline.")
 
+    # ====== 今天列已在收盘后抓过：没有缺失数据，整次跳过请求 ======
+    if not wide.empty and not refresh and today_is_final(wide, today_col, out_csv, last_trade_day):
+        print(f"[info] {today_col} already fetched after {MARKET_CLOSE}, skip fetching (use --refresh to force).")
+        return
+
     # ====== 如果没有基线，先建一次（push2his；可能慢，但只做一次）======
     if wide.empty:
         print("[stage] bootstrap baseline (push2his, may take time)…")
@@ -583,44 +510,38 @@ def build_csv(
         total = len(boards)
         print(f"[info] total boards (list): {total}")
 
-        # rpm 限速器
+        # rpm 限速器（并发请求共享）
         min_interval_s = 60.0 / rpm if rpm and rpm > 0 else 0.0
-        last_ts_holder = [None]
-
-        all_rows = []
-        consec_fail = 0
-        for i, (code, name) in enumerate(boards, start=1):
-            if INTERRUPTED:
-                print("[warn] interrupted, flushing baseline…")
-                break
-            polite_sleep(min_interval_s, sleep_s, jitter_s, last_ts_holder)
-
-            ok = False; err = None; recs = None
-            backoff = 0.6
-            for attempt in range(RETRY_TIMES):
-                try:
-                    beg = (last_trade_day - pd.Timedelta(days=n_days*2)).strftime("%Y%m%d")
-                    recs = _fetch_range(session, code, beg, today_str, verbose_http)
-                    ok = True; break
-                except (ProxyError, ReqConnErr, ReadTimeout) as e:
-                    err = e; time.sleep(backoff + random.uniform(0, 0.35)); backoff *= 2
-                except Exception as e:
-                    err = e; time.sleep(backoff); backoff *= 2
-
-            if ok and recs:
-                df = pd.DataFrame(recs, columns=["trade_date", "pct_chg", "close"])
-                df["bk_code"] = code; df["bk_name"] = name
-                all_rows.append(df); consec_fail = 0
-                print(f"[full {i:02d}/{total}] {code}|{name} ok ({len(recs)})")
-            else:
-                consec_fail += 1
-                print(f"[full {i:02d}/{total}] {code}|{name} FAIL: {err}")
-                if consec_fail >= cooldown_after:
-                    print(f"[cooldown] consecutive fails={consec_fail} → sleep {cooldown_secs}s")
-                    time.sleep(cooldown_secs); consec_fail = 0
+        pacer = AsyncPacer(min_interval_s, sleep_s, jitter_s)
+
+        beg = baseline_begin(today_col, n_days)  # 按交易日历取正好 n_days 个交易日，不再多要一倍
+
+        # 收盘后窗口内 K 线不再变化：按 (fs, beg, end) 缓存到磁盘，重建基线时只请求缓存里没有的板块
+        cache_path = kline_cache_path(fs, beg, today_str)
+        cached = {} if refresh else load_kline_cache(cache_path)
+        todo = [(c, n) for c, n in boards if f"{c}|{n}" not in cached]
+        if cached:
+            print(f"[info] klines from cache: {total - len(todo)}/{total} ({cache_path})")
+
+        fetched = dict(asyncio.run(fetch_baseline_async(
+            todo, beg, today_str,
+            timeout_s=timeout_s,
+            concurrency=concurrency,
+            pacer=pacer,
+            cooldown_after=cooldown_after,
+            cooldown_secs=cooldown_secs,
+            verbose_http=verbose_http,
+        ))) if todo else {}
+        if fetched and time.time() >= close_ts(last_trade_day):
+            save_kline_cache(cache_path, {**cached, **fetched})
+
+        keys = [f"{c}|{n}" for c, n in boards]
+        all_rows = [(k, cached.get(k) or fetched[k]) for k in keys if k in cached or k in fetched]
 
         if all_rows:
-            write_baseline(all_rows, out_csv)
+            write_baseline(all_rows, out_csv, write_csv)
+            if not interrupted():
+                mark_fetched(out_csv, today_col, fetch_ts)
         return
 
     # ====== 有基线：今天列采用“批量抓”方案（默认）======
@@ -631,7 +552,9 @@ def build_csv(
             if df_today.empty:
                 print("[warn] clist/get returns empty, keep old today column.")
             else:
-                patch_today(wide, df_today, today_col, out_csv)
+                patch_today(wide, df_today, today_col, out_csv, write_csv)
+                if not interrupted():
+                    mark_fetched(out_csv, today_col, fetch_ts)
             ok_n = df_today["pct_chg"].notna().sum() if not df_today.empty else 0
             total = len(df_today) if not df_today.empty else 0
             print(f"[summary] today (list): ok={ok_n}, total={total}, date={today_col}")
@@ -646,75 +569,18 @@ def build_csv(
     print(f"[info] total boards (list): {total}")
 
     min_interval_s = 60.0 / rpm if rpm and rpm > 0 else 0.0
-    last_ts_holder = [None]
-
-    rows_today: Dict[str, Dict] = {}
-    fails: List[Tuple[str, str]] = []
-    consec_fail = 0
-
-    # Pass1
-    for i, (code, name) in enumerate(boards, start=1):
-        if INTERRUPTED:
-            print("[warn] interrupted by user during Pass1, flushing partial…")
-            break
-        polite_sleep(min_interval_s, sleep_s, jitter_s, last_ts_holder)
-
-        ok = False; err = None; recs = None
-        backoff = 0.6
-        for attempt in range(RETRY_TIMES):
-            try:
-                recs = _fetch_range(session, code, today_str, today_str, verbose_http)
-                ok = True; break
-            except (ProxyError, ReqConnErr, ReadTimeout) as e:
-                err = e; time.sleep(backoff + random.uniform(0, 0.35)); backoff *= 2
-            except Exception as e:
-                err = e; time.sleep(backoff); backoff *= 2
-
-        if ok and recs:
-            _, pct, close = recs[0]
-            rows_today[code] = {"bk_code": code, "bk_name": name, "pct_chg": pct, "close": close}
-            consec_fail = 0
-            print(f"[today {i:02d}/{total}] {code}|{name} ok")
-        else:
-            rows_today[code] = {"bk_code": code, "bk_name": name, "pct_chg": None, "close": None}
-            fails.append((code, name))
-            consec_fail += 1
-            print(f"[today {i:02d}/{total}] {code}|{name} FAIL: {err}")
-            if consec_fail >= cooldown_after:
-                print(f"[cooldown] consecutive fails={consec_fail} → sleep {cooldown_secs}s")
-                time.sleep(cooldown_secs); consec_fail = 0
-
-    # Pass2（可选）
-    if fails and not INTERRUPTED:
-        print(f"[info] Pass2 retry for {len(fails)} failed boards (slower pacing)…")
-        session2 = build_session(pass2_timeout)
-        min_interval_s2 = 60.0 / (rpm/2.0) if rpm and rpm > 0 else 0.0
-        last_ts_holder2 = [None]
-
-        for j, (code, name) in enumerate(fails, start=1):
-            if INTERRUPTED:
-                print("[warn] interrupted by user during Pass2, flushing partial…")
-                break
-
-            polite_sleep(min_interval_s2, pass2_sleep, pass2_sleep/2, last_ts_holder2)
-
-            ok = False; err = None; recs = None
-            backoff = 1.0
-            for attempt in range(RETRY_TIMES + 1):
-                try:
-                    recs = _fetch_range(session2, code, today_str, today_str, verbose_http)
-                    ok = True; break
-                except (ProxyError, ReqConnErr, ReadTimeout) as e:
-                    err = e; time.sleep(backoff + random.uniform(0, 0.5)); backoff *= 2
-                except Exception as e:
-                    err = e; time.sleep(backoff); backoff *= 2
-
-            if ok and recs:
-                _, pct, close = recs[0]
-                rows_today[code] = {"bk_code": code, "bk_name": name, "pct_chg": pct, "close": close}
-                print(f"[pass2 {j:02d}/{len(fails)}] {code}|{name} ok")
-            else:
-                print(f"[pass2 {j:02d}/{len(fails)}] {code}|{name} FAIL: {err}")
+    min_interval_s2 = 60.0 / (rpm/2.0) if rpm and rpm > 0 else 0.0
+    df_today = asyncio.run(fetch_today_his_async(
+        boards, today_str,
+        timeout_s=timeout_s,
+        concurrency=concurrency,
+        pacer=AsyncPacer(min_interval_s, sleep_s, jitter_s),
+        cooldown_after=cooldown_after,
+        cooldown_secs=cooldown_secs,
+        pass2_timeout=pass2_timeout,
+        pass2_pacer=AsyncPacer(min_interval_s2, pass2_sleep, pass2_sleep/2),
+        verbose_http=verbose_http,
+    ))
 
     # 写回
     # 确保索引齐全
@@ -723,13 +589,14 @@ def build_csv(
         wide.index.name = "row_key"
     wide = wide.reindex(all_index)
 
-    df_today = pd.DataFrame(list(rows_today.values()))
     if not df_today.empty:
-        patch_today(wide, df_today, today_col, out_csv)
+        patch_today(wide, df_today, today_col, out_csv, write_csv)
+        if not interrupted():
+            mark_fetched(out_csv, today_col, fetch_ts)
     else:
         print("[warn] nothing fetched; skip writing.")
 
-    ok_n = sum(1 for v in rows_today.values() if v["pct_chg"] is not None)
+    ok_n = df_today["pct_chg"].notna().sum()
     print(f"[summary] today (his): ok={ok_n}, fail={total-ok_n}, date={today_col}")
 
 
@@ -749,6 +616,7 @@ def parse_args():
     ap.add_argument("--cooldown-after", type=int, default=20, help="global cooldown after N consecutive fails")
     ap.add_argument("--cooldown-secs", type=float, default=8.0, help="global cooldown seconds")
     ap.add_argument("--timeout", type=float, default=10, help="per-request timeout seconds (Pass1)")
+    ap.add_argument("--concurrency", type=int, default=8, help="max in-flight kline requests (baseline & his mode)")
 
     # Pass2（仅 his 模式会用到）
     ap.add_argument("--pass2-timeout", type=float, default=9.0, help="per-request timeout seconds (Pass2)")
@@ -759,6 +627,8 @@ def parse_args():
 
     # 今天抓取模式：list（默认，强烈推荐）/ his（逐板块历史接口，兼容用）
     ap.add_argument("--today-mode", choices=["list","his"], default="list", help="how to fetch today's column")
+    ap.add_argument("--refresh", action="store_true", help="refetch TODAY even if it was already written after market close")
+    ap.add_argument("--no-csv", action="store_true", help="write only the parquet copy (intraday polling); rerun without it to export CSV")
     return ap.parse_args()
 
 
@@ -778,4 +648,7 @@ if __name__ == "__main__":
         pass2_sleep=args.pass2_sleep,
         verbose_http=args.verbose_http,
         today_mode=args.today_mode,
+        concurrency=args.concurrency,
+        refresh=args.refresh,
+        write_csv=not args.no_csv,
     )
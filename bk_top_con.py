@@ -18,6 +18,11 @@ import plotly.graph_objects as go
 from plotly.colors import qualitative
 from datetime import datetime
 
+from bk_common import (
+    CELL_FIELDS, parse_cells, load_wide, wide_columns,
+    long_cache_key, load_long_cache, save_long_cache, write_fig_html,
+)
+
 # ================== 参数 ==================
 TOP_N_RANK = 30  # rank 页面 TOP
 TOP_N_RANGE = 20 # range 页面 TOP
@@ -28,40 +33,14 @@ LOOKBACK_LIST = [1, 5]
 END_DATE = None
 INPUT_CSV = "data/data_concept.csv"
 
+PLOTLYJS = "inline"  # "cdn"：HTML 只引用 cdn.plot.ly，单页小约 4.7MB，但打开需联网
+
 # range 图专用参数
 BAR_DAY_FRACTION = 0.8
 ROW_HALF_HEIGHT = 0.45
 
-# ================== 工具函数 ==================
-def parse_triplet(cell):
-    if pd.isna(cell):
-        return (np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, "")
-
-    try:
-        parts = str(cell).split("|")
-        parts += [""] * (7 - len(parts))  # 兼容旧数据
-
-        r = int(float(parts[0])) if parts[0] not in ("", "nan") else np.nan
-        pct = float(parts[1]) / 100.0 if parts[1] not in ("", "nan") else np.nan
-        val = float(parts[2]) if parts[2] not in ("", "nan") else np.nan
-        turnover = float(parts[3]) if parts[3] not in ("", "nan") else np.nan
-        up = int(parts[4]) if parts[4] not in ("", "nan") else np.nan
-        down = int(parts[5]) if parts[5] not in ("", "nan") else np.nan
-        leader = parts[6]
-
-        return r, pct, val, turnover, up, down, leader
-    except Exception:
-        return (np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, "")
-
-
-
-
 # ================== 数据准备 ==================
 def prepare_data():
-    df = pd.read_csv(INPUT_CSV)
-    key_split = df["row_key"].astype(str).str.split("|", n=1, expand=True)
-    df["board_name"] = key_split[1].fillna(key_split[0]).str.strip()
-
     # ===== 新增：过滤掉不需要的板块 =====
     EXCLUDE_BOARDS = {
         "昨日涨停_含一字",
@@ -80,88 +59,85 @@ def prepare_data():
         "2025三季报预增",
         "并购重组概念",
     }
-    df = df[~df["board_name"].isin(EXCLUDE_BOARDS)].reset_index(drop=True)
     # ==========================================
 
+    columns = wide_columns(INPUT_CSV)  # 先只读表头确定日期列
     non_date = {"row_key", "board_code", "board_name"}
-    raw_date_cols = [c for c in df.columns if c not in non_date]
+    raw_date_cols = [c for c in columns if c not in non_date]
+    # 整个列名一次转日期，argsort 排序（不逐对 Python 排序）
     col_dt = pd.to_datetime(raw_date_cols, errors="coerce")
-
-    all_dates = [(c, d) for c, d in zip(raw_date_cols, col_dt) if pd.notna(d)]
-    all_dates.sort(key=lambda x: x[1])
+    valid = np.flatnonzero(col_dt.notna())
+    valid = valid[np.argsort(col_dt[valid], kind="stable")]
+    all_cols = [raw_date_cols[i] for i in valid]
+    all_dt = col_dt[valid]
 
     # 页面展示日期
-    display_dates = all_dates[-N_DAYS:] if N_DAYS > 0 else all_dates
-    display_cols = [c for c, _ in display_dates]
-    display_dt = [d for _, d in display_dates]
+    display_cols = all_cols[-N_DAYS:] if N_DAYS > 0 else all_cols
+    display_dt = list(all_dt[-N_DAYS:] if N_DAYS > 0 else all_dt)
 
     # 计算日期
-    calc_dates = all_dates
-    if END_DATE:
-        end_dt = pd.to_datetime(END_DATE)
-        calc_dates = [(c, d) for c, d in calc_dates if d <= end_dt]
-    calc_dates = calc_dates[-N_DAYS:] if N_DAYS > 0 else calc_dates
-    calc_cols = [c for c, _ in calc_dates]
-    calc_dt = [d for _, d in calc_dates]
-
-    # 解析 rank/pct/val
-    parsed = {
-        c: pd.DataFrame(
-            df[c].apply(parse_triplet).tolist(),
-            columns=["rank", "pct", "val", "turnover", "up", "down", "leader"],
-            index=df.index
-        )
-        for c in display_cols
-    }
+    calc_dt = all_dt[all_dt <= pd.to_datetime(END_DATE)] if END_DATE else all_dt
+    calc_dt = list(calc_dt[-N_DAYS:] if N_DAYS > 0 else calc_dt)
+
+    # 解析结果按（CSV 版本, 展示列, 排除板块）缓存，输入没变就跳过读表和解析
+    cache_path = os.path.splitext(INPUT_CSV)[0] + ".long.parquet"
+    cache_key = long_cache_key(INPUT_CSV, display_cols, EXCLUDE_BOARDS)
+    long_df = load_long_cache(cache_path, cache_key)
+    if long_df is None:
+        df = load_wide(INPUT_CSV)
+        key_split = df["row_key"].astype(str).str.split("|", n=1, expand=True)
+        df["board_name"] = key_split[1].fillna(key_split[0]).str.strip()
+        df = df[~df["board_name"].isin(EXCLUDE_BOARDS)].reset_index(drop=True)
+
+        # 解析 rank/pct/val
+        parsed = parse_cells(df[display_cols])
+
+        # 构建 long_df（按日期分块、块内按板块顺序，直接由二维数组展开）
+        # board_name 用 category：groupby / pivot / isin 走整数编码，名称字符串每个板块只存一份
+        n_boards = len(df)
+        long_df = pd.DataFrame({
+            "date": pd.DatetimeIndex(display_dt).repeat(n_boards),
+            "board_name": pd.Categorical(np.tile(df["board_name"].to_numpy(), len(display_cols))),
+            **{f: parsed[f].to_numpy().ravel(order="F") for f in CELL_FIELDS},
+        })
+        # 名次 / 涨跌家数是整数（含 NaN），float32 可精确表示，内存与缓存减半；pct/val/turnover 参与累计和悬停显示，保持 float64
+        long_df = long_df.astype({"rank": "float32", "up": "float32", "down": "float32"})
+        save_long_cache(long_df, cache_path, cache_key)
 
-    # 构建 long_df
-    records = []
-    for c, d in zip(display_cols, display_dt):
-        p = parsed[c]
-        for i in p.index:
-            records.append({
-                "date": d,
-                "board_name": df.at[i, "board_name"],
-                "rank": p.at[i, "rank"],
-                "pct": p.at[i, "pct"],
-                "val": p.at[i, "val"],
-                "turnover": p.at[i, "turnover"],
-                "up": p.at[i, "up"],
-                "down": p.at[i, "down"],
-                "leader": p.at[i, "leader"],
-            })
-
-    long_df = pd.DataFrame(records)
     latest_date = display_dt[-1]  # display_dt 已经是排序后的日期列表
     latest_date_str = latest_date.strftime("%m%d")
     return long_df, display_dt, calc_dt, latest_date_str
 
 
 # ================== 累计涨幅计算 ==================
-def compute_cum_pct(long_df, calc_dt, LOOKBACK, top_n):
-    pivot = long_df.pivot_table(
+def build_pct_pivot(long_df):
+    """板块 × 日期 的涨幅表，与 LOOKBACK 无关：主流程只建一次，各 LOOKBACK / 各图共用"""
+    return long_df.pivot_table(
         index="board_name",
         columns="date",
         values="pct",
-        aggfunc="mean"
+        aggfunc="mean",
+        observed=True,
     ).fillna(0.0)
 
+
+def compute_cum_pct(pivot, calc_dt, LOOKBACK, top_n):
     lookback_dt = calc_dt[-LOOKBACK:] if len(calc_dt) >= LOOKBACK else calc_dt
-    cum_pct = pivot[lookback_dt].sum(axis=1).sort_values(ascending=False)
-    top_boards = cum_pct.head(top_n).index.tolist()
-    cum_pct = cum_pct.loc[top_boards]
+    # 只取前 top_n，nlargest 部分选择，不对全部板块整列排序
+    cum_pct = pivot[lookback_dt].sum(axis=1).nlargest(top_n)
+    top_boards = cum_pct.index.tolist()
 
     return top_boards, cum_pct
 
 # ================== rank 图 ==================
-def generate_rank_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
+def generate_rank_html(long_df, pivot, display_dt, calc_dt, LOOKBACK, file_date_str):
     month_str = file_date_str[:2]   # "02"
     day_str = file_date_str[2:]    # "05"
     output_dir = f"html/{month_str}/{day_str}"
     os.makedirs(output_dir, exist_ok=True)
 
     OUTPUT_HTML = f"{output_dir}/con_dot_{LOOKBACK}_{file_date_str}.html"
-    top_boards, cum_pct = compute_cum_pct(long_df, calc_dt, LOOKBACK, TOP_N_RANK)
+    top_boards, cum_pct = compute_cum_pct(pivot, calc_dt, LOOKBACK, TOP_N_RANK)
     board_order = top_boards
     df_plot = long_df[long_df["board_name"].isin(top_boards)]
 
@@ -173,70 +149,61 @@ def generate_rank_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
 
     fig = go.Figure()
 
-    # Scatter 点
-    for r in range(1, MARK_TOP+1):
-        sub = df_plot[df_plot["rank"]==r]
-        if sub.empty:
-            continue
-        color = rank_colors[r] if r <= MARK_TOP else "rgba(0,0,0,0)"  # 前10彩色，其余透明
-        fig.add_trace(go.Scatter(
-            x=sub["date"],
-            y=sub["board_name"],
+    # customdata / hovertemplate 对整个 df_plot 只构建一次，各名次 trace 按位置切片
+    custom = np.stack([
+        df_plot["rank"], df_plot["pct"].round(4), df_plot["val"],
+        df_plot["turnover"], df_plot["up"], df_plot["down"], df_plot["leader"]
+    ], axis=-1)
+    hovertemplate = (
+        "版块：%{y}<br>"
+        "日期：%{x|%Y-%m-%d}<br>"
+        "名次：%{customdata[0]}<br>"
+        "涨跌幅：%{customdata[1]:.2%}<br>"
+        # "指数：%{customdata[2]:,.2f}<br>"
+        "换手率：%{customdata[3]:.2f}%<br>"
+        "上涨家数：%{customdata[4]}<br>"
+        "下跌家数：%{customdata[5]}<br>"
+        "领涨股：%{customdata[6]}"
+        "<extra></extra>"
+    )
+
+    # Scatter 点：一次 groupby 拿到各名次的行位置，前10名每名一条彩色 trace
+    # 用 Scattergl（WebGL 绘制），点多时缩放 / 悬停不卡，不再每点一个 SVG 节点
+    rank_pos = df_plot.groupby("rank").indices
+    for r in sorted(k for k in rank_pos if k <= MARK_TOP):
+        idx = rank_pos[r]
+        r = int(r)
+        fig.add_trace(go.Scattergl(
+            x=df_plot["date"].iloc[idx],
+            y=df_plot["board_name"].iloc[idx],
             mode="markers",
-            name=f"第{r}名" if r <= MARK_TOP else None,
-            marker=dict(size=8, color=color),
-            customdata=np.stack([
-                sub["rank"], sub["pct"], sub["val"],
-                sub["turnover"], sub["up"], sub["down"], sub["leader"]
-            ], axis=-1),
-            hovertemplate=(
-                "版块：%{y}<br>"
-                "日期：%{x|%Y-%m-%d}<br>"
-                "名次：%{customdata[0]}<br>"
-                "涨跌幅：%{customdata[1]:.2%}<br>"
-                # "指数：%{customdata[2]:,.2f}<br>"
-                "换手率：%{customdata[3]:.2f}%<br>"
-                "上涨家数：%{customdata[4]}<br>"
-                "下跌家数：%{customdata[5]}<br>"
-                "领涨股：%{customdata[6]}"
-                "<extra></extra>"
-            ),
-
-            showlegend=r <= MARK_TOP  # 只显示前10名的图例
+            name=f"第{r}名",
+            marker=dict(size=8, color=rank_colors[r]),
+            customdata=custom[idx],
+            hovertemplate=hovertemplate,
+            showlegend=True  # 只显示前10名的图例
         ))
 
-    # 处理不在前10的点
-    sub_other = df_plot[df_plot["rank"] > MARK_TOP]
-    if not sub_other.empty:
-        fig.add_trace(go.Scatter(
-            x=sub_other["date"],
-            y=sub_other["board_name"],
+    # 处理不在前10的点（透明，只为悬停信息）
+    other = np.flatnonzero(df_plot["rank"].to_numpy() > MARK_TOP)
+    if len(other):
+        fig.add_trace(go.Scattergl(
+            x=df_plot["date"].iloc[other],
+            y=df_plot["board_name"].iloc[other],
             mode="markers",
             name="其它",
             marker=dict(size=6, color="rgba(0,0,0,0)"),  # 透明点
-            customdata=np.stack([
-                sub_other["rank"], sub_other["pct"], sub_other["val"],
-                sub_other["turnover"], sub_other["up"], sub_other["down"], sub_other["leader"]
-            ], axis=-1),
-            hovertemplate=(
-                "版块：%{y}<br>"
-                "日期：%{x|%Y-%m-%d}<br>"
-                "名次：%{customdata[0]}<br>"
-                "涨跌幅：%{customdata[1]:.2%}<br>"
-                # "指数：%{customdata[2]:,.2f}<br>"
-                "换手率：%{customdata[3]:.2f}%<br>"
-                "上涨家数：%{customdata[4]}<br>"
-                "下跌家数：%{customdata[5]}<br>"
-                "领涨股：%{customdata[6]}"
-                "<extra></extra>"
-            ),
-
+            customdata=custom[other],
+            hovertemplate=hovertemplate,
             showlegend=False
         ))
 
-
-    for d in display_dt:
-        fig.add_vline(x=d, line_width=1, line_dash="dot", opacity=0.25)
+    # 每日竖虚线：一次性生成 shapes 列表随 update_layout 写入（不逐条 add_vline 改 layout）
+    day_lines = [
+        dict(type="line", xref="x", yref="y domain", x0=d, x1=d, y0=0, y1=1,
+             line=dict(width=1, dash="dot"), opacity=0.25)
+        for d in display_dt
+    ]
 
     # ---------- 右侧累计涨幅 ----------
     annotations = []
@@ -282,10 +249,11 @@ def generate_rank_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
         legend=dict(x=1.05, y=1.0),
         height=900,
         margin=dict(l=150, r=220, t=90, b=50),
+        shapes=day_lines,
         annotations=annotations
     )
 
-    fig.write_html(OUTPUT_HTML, include_plotlyjs="inline")
+    write_fig_html(fig, OUTPUT_HTML, PLOTLYJS)
 
        # ---------- 增加一键复制按钮 ----------
     # with open(OUTPUT_HTML, "r+", encoding="utf-8") as f:
@@ -310,14 +278,14 @@ def generate_rank_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
     print(f"[OK] rank HTML 已生成：{OUTPUT_HTML}")
 
 # ================== range 图 ==================
-def generate_range_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
+def generate_range_html(long_df, pivot, display_dt, calc_dt, LOOKBACK, file_date_str):
     month_str = file_date_str[:2]   # "02"
     day_str = file_date_str[2:]    # "05"
     output_dir = f"html/{month_str}/{day_str}"
     
     os.makedirs(output_dir, exist_ok=True)
     OUTPUT_HTML = f"{output_dir}/con_bar_{LOOKBACK}_{file_date_str}.html"
-    top_boards, cum_pct = compute_cum_pct(long_df, calc_dt, LOOKBACK, TOP_N_RANGE)
+    top_boards, cum_pct = compute_cum_pct(pivot, calc_dt, LOOKBACK, TOP_N_RANGE)
     df_plot = long_df[long_df["board_name"].isin(top_boards)]
     board_order = top_boards
     board_y = {b:i+1 for i,b in enumerate(board_order)}
@@ -325,61 +293,56 @@ def generate_range_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
     max_abs = np.nanmax(np.abs(df_plot["pct"]))
     scale = ROW_HALF_HEIGHT / max_abs if max_abs>0 else 0
     fig = go.Figure()
-    shapes = []
 
     one_day_ms = 24*3600*1000
-    half_bar = BAR_DAY_FRACTION*one_day_ms/2
     x_min, x_max = min(display_dt), max(display_dt)
 
-    hover_x, hover_y, hover_text = [], [], []
-
-    # 红绿柱
-    for _, r in df_plot.iterrows():
-        if pd.isna(r["pct"]) or r["pct"]==0:
-            continue
-        y0 = board_y[r["board_name"]]
-        y1 = y0 - r["pct"]*scale
-        x0 = r["date"] - pd.Timedelta(milliseconds=half_bar)
-        x1 = r["date"] + pd.Timedelta(milliseconds=half_bar)
-        shapes.append(dict(
-            type="rect",
-            x0=x0, x1=x1,
-            y0=min(y0,y1), y1=max(y0,y1),
-            fillcolor="rgba(220,0,0,0.85)" if r["pct"]>0 else "rgba(0,140,0,0.85)",
-            line=dict(width=0)
-        ))
-        hover_x.append(r["date"])
-        hover_y.append(y1)
-        hover_text.append(
-            f"版块：{r['board_name']}<br>"
-            f"日期：{r['date'].date()}<br>"
-            f"涨跌幅：{r['pct']:+.2%}<br>"
-            # f"指数：{r['val']:,.2f}<br>"
-            f"换手率：{r['turnover']:.2f}%<br>"
-            f"上涨家数：{int(r['up']) if pd.notna(r['up']) else ''}<br>"
-            f"下跌家数：{int(r['down']) if pd.notna(r['down']) else ''}<br>"
-            f"领涨股：{r['leader']}"
-        )
-
-
-    # 水平基准线
-    for b, y in board_y.items():
-        shapes.append(dict(
-            type="line",
-            x0=x_min, x1=x_max,
-            y0=y, y1=y,
-            line=dict(color="rgba(0,0,0,0.25)", width=1)
-        ))
+    # 只画非零涨跌；悬停只传原始值 customdata，由 hovertemplate 在浏览器端格式化（不在 Python 里逐条拼字符串）
+    bars = df_plot[df_plot["pct"].notna() & (df_plot["pct"] != 0)]
+
+    # 换手率 / 涨跌家数 / 领涨股常缺失：先转成字符串、缺失留空（NaN 传进去会被 d3 显示成 0.00% / null）
+    def _blank(s, text):
+        return text.where(s.notna(), "")
+
+    custom = np.stack([
+        bars["board_name"], bars["pct"].round(4), bars["val"],
+        _blank(bars["turnover"], bars["turnover"].map("{:.2f}%".format)),
+        _blank(bars["up"], bars["up"].astype("Int64").astype(str)),
+        _blank(bars["down"], bars["down"].astype("Int64").astype(str)),
+        bars["leader"].fillna(""),
+    ], axis=-1)
+    hovertemplate = (
+        "版块：%{customdata[0]}<br>"
+        "日期：%{x|%Y-%m-%d}<br>"
+        "涨跌幅：%{customdata[1]:+.2%}<br>"
+        # "指数：%{customdata[2]:,.2f}<br>"
+        "换手率：%{customdata[3]}<br>"
+        "上涨家数：%{customdata[4]}<br>"
+        "下跌家数：%{customdata[5]}<br>"
+        "领涨股：%{customdata[6]}"
+        "<extra></extra>"
+    )
 
-    fig.update_layout(shapes=shapes)
+    # 红绿柱：一条 Bar trace，柱底 base 在板块基准线上，高度 = -pct*scale（代替逐柱 rect shape，悬停直接挂在柱上）
+    pct = bars["pct"].to_numpy(dtype=float)
+    y0 = bars["board_name"].map(board_y).to_numpy(dtype=float)
+    fig.add_trace(go.Bar(
+        x=bars["date"], y=-pct*scale, base=y0,
+        width=BAR_DAY_FRACTION*one_day_ms,
+        marker=dict(color=np.where(pct > 0, "rgba(220,0,0,0.85)", "rgba(0,140,0,0.85)"), line=dict(width=0)),
+        customdata=custom,
+        hovertemplate=hovertemplate,
+        showlegend=False
+    ))
 
-    # hover
+    # 水平基准线：一条 Scatter，线段之间用 None 断开
+    n_rows = len(board_y)
     fig.add_trace(go.Scatter(
-        x=hover_x, y=hover_y,
-        mode="markers",
-        marker=dict(size=1, opacity=0),
-        hovertext=hover_text,
-        hoverinfo="text",
+        x=[x_min, x_max, None] * n_rows,
+        y=[v for y in board_y.values() for v in (y, y, None)],
+        mode="lines",
+        line=dict(color="rgba(0,0,0,0.25)", width=1),
+        hoverinfo="skip",
         showlegend=False
     ))
 
@@ -425,12 +388,13 @@ def generate_range_html(long_df, display_dt, calc_dt, LOOKBACK, file_date_str):
         hovermode="closest"
     )
 
-    fig.write_html(OUTPUT_HTML, include_plotlyjs="inline")
+    write_fig_html(fig, OUTPUT_HTML, PLOTLYJS)
     print(f"[OK] range HTML 已生成：{OUTPUT_HTML}")
 
 # ================== 批量执行 ==================
 if __name__ == "__main__":
     long_df, display_dt, calc_dt, latest_date_str = prepare_data()
+    pivot = build_pct_pivot(long_df)
     for lb in LOOKBACK_LIST:
-        generate_rank_html(long_df, display_dt, calc_dt, lb, latest_date_str)
-        # generate_range_html(long_df, display_dt, calc_dt, lb, latest_date_str)
+        generate_rank_html(long_df, pivot, display_dt, calc_dt, lb, latest_date_str)
+        # generate_range_html(long_df, pivot, display_dt, calc_dt, lb, latest_date_str)